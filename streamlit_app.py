@@ -12,18 +12,79 @@ import difflib
 import zipfile
 import io
 import time, random
+import os
+import sqlite3
+import json
+import threading
+import hmac, hashlib, base64
+import unicodedata
+from functools import lru_cache
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from zoneinfo import ZoneInfo
 BASE_URL_QR = "https://dhnamgh.github.io/car/"   # chạy qua GitHub
+CARD_RE = r"[A-Z]{2,3}\d{3}"  # Mã thẻ = mã đơn vị (2–3 chữ, vd TV, TRY) + 3 số
 
 def qr_target_id_from_row(row):
     """Ưu tiên id = Mã thẻ (TRY001…), nếu chưa có thì dùng biển số chuẩn hóa."""
     code = str(row.get("Mã thẻ", "")).strip().upper()
-    if re.fullmatch(r"[A-Z]{3}\d{3}", code):
+    if re.fullmatch(CARD_RE, code):
         return code
     return normalize_plate(row.get("Biển số", ""))
 
-def make_qr_link_from_row(row):
-    vid = qr_target_id_from_row(row)
-    return f"{BASE_URL_QR}?id={urllib.parse.quote(vid)}"
+# --- QR ký số: p = 1.<Mã thẻ>.<Biển số>.<Mã đơn vị>.<hết hạn base36>.<HMAC> ---
+# Cổng kiểm tra chữ ký tại chỗ, không cần tra danh bạ (vẫn dùng được khi Google Sheets lỗi).
+QR_PAYLOAD_VERSION = "1"
+QR_SIG_BYTES = 12  # 96 bit → 16 ký tự base64url, đủ ngắn cho mã QR
+
+def _b36(n: int) -> str:
+    digits = "0123456789abcdefghijklmnopqrstuvwxyz"
+    out = ""
+    while True:
+        n, r = divmod(n, 36)
+        out = digits[r] + out
+        if not n:
+            return out
+
+def _qr_sig(body: str, key: bytes) -> str:
+    mac = hmac.new(key, body.encode("utf-8"), hashlib.sha256).digest()[:QR_SIG_BYTES]
+    return base64.urlsafe_b64encode(mac).decode().rstrip("=")
+
+def sign_qr_payload(card: str, plate: str, unit: str, exp_ts: int, key: bytes) -> str:
+    fields = [re.sub(r"[^A-Z0-9]", "", str(x).upper()) for x in (card, plate, unit)]
+    body = ".".join([QR_PAYLOAD_VERSION, *fields, _b36(int(exp_ts))])
+    return f"{body}.{_qr_sig(body, key)}"
+
+def verify_qr_payload(payload: str, key: bytes, now: float = None):
+    """Trả dict thông tin xe nếu chữ ký đúng & còn hạn, ngược lại None."""
+    parts = str(payload).split(".")
+    if len(parts) != 6 or parts[0] != QR_PAYLOAD_VERSION or not key:
+        return None
+    body, sig = ".".join(parts[:5]), parts[5]
+    if not hmac.compare_digest(sig.encode("utf-8"), _qr_sig(body, key).encode()):
+        return None
+    try:
+        exp = int(parts[4], 36)
+    except ValueError:
+        return None
+    if exp <= (time.time() if now is None else now):
+        return None
+    return {"Mã thẻ": parts[1], "Biển số": parts[2], "Mã đơn vị": parts[3], "Hết hạn": exp}
+
+def make_qr_link(card: str = "", plate: str = "", unit: str = "",
+                 signing_key: bytes = b"", ttl_days: int = 365) -> str:
+    """Link QR duy nhất cho mọi nơi: ?id=<Mã thẻ | biển số chuẩn hóa>[&p=<payload ký số>]."""
+    vid = qr_target_id_from_row({"Mã thẻ": card, "Biển số": plate})
+    url = f"{BASE_URL_QR}?id={urllib.parse.quote(vid)}"
+    if signing_key:
+        exp = int(time.time() + ttl_days * 86400)
+        url += f"&p={sign_qr_payload(card, plate, unit, exp, signing_key)}"
+    return url
+
+def make_qr_link_from_row(row, signing_key: bytes = b"", ttl_days: int = 365):
+    return make_qr_link(row.get("Mã thẻ", ""), row.get("Biển số", ""), row.get("Mã đơn vị", ""),
+                        signing_key=signing_key, ttl_days=ttl_days)
 
 # --- helper lấy biến secret bất chấp viết hoa/thường/thừa khoảng trắng ---
 def _get_secret(*names: str) -> str:
@@ -36,6 +97,11 @@ def _get_secret(*names: str) -> str:
             return str(v)
     return ""
 
+def qr_signing_key() -> bytes:
+    """Khóa ký QR (secrets['qr_signing_key']); rỗng → không ký."""
+    k = _get_secret("qr_signing_key", "QR_SIGNING_KEY")
+    return hashlib.sha256(k.encode("utf-8")).digest() if k else b""
+
 # ==========================
 # CẤU HÌNH CHUNG & HỖ TRỢ
 # ==========================
@@ -50,10 +116,114 @@ DON_VI_MAP = {
     "TT.KHCN UMP": "KCU", "TT.YSHPT": "YSH", "Thư viện": "TV", "KTX": "KTX", "Tạp chí Y học": "TCY",
     "BV ĐHYD": "BVY", "TT. GDYH": "GDY", "VPĐ": "VPD", "YHCT": "YHC", "HTQT": "HTQ"
 }
+DON_VI_TEN_DAY_DU = {
+    "HCTH": "Phòng Hành Chính Tổng hợp",
+    "TCCB": "Phòng Tổ chức Cán bộ",
+    "ĐTĐH": "Phòng Đào tạo Đại học",
+    "ĐTSĐH": "Phòng Đào tạo Sau đại học",
+    "KHCN": "Phòng Khoa học Công nghệ",
+    "KHTC": "Phòng Kế hoạch Tài chính",
+    "QTGT": "Phòng Quản trị Giáo tài",
+    "TTPC": "Phòng Thanh tra Pháp chế",
+    "ĐBCLGD&KT": "Phòng Đảm bảo chất lượng GD và Khảo thí",
+    "CTSV": "Phòng Công tác sinh viên",
+    "KHCB": "Khoa Khoa học Cơ bản",
+    "RHM": "Khoa Răng hàm mặt",
+    "YTCC": "Khoa Y tế Công cộng",
+    "PK.CKRHM": "Phòng khám Răng hàm mặt",
+    "TT.KCCLXN": "Trung tâm Kiểm chuẩn Chât lượng xét nghiệm",
+    "TT.KHCN UMP": "Trung tâm Khoa học Công nghệ UMP",
+    "TT.YSHPT": "Trung tâm Y sinh học phân tử",
+    "KTX": "Ký túc xá",
+    "BV ĐHYD": "Bệnh viện Đại học Y Dược",
+    "TT.PTTN": "Trung tâm Phẫn thuật thực nghiệm",
+    "TT. GDYH": "Trung tâm Giáo dục Y học",
+    "VPĐ": "Văn phòng Đoàn thể",
+    "Trường Y": "Trường Y",
+    "Trường Dược": "Trường Dược",
+    "Trường ĐD-KTYH": "Trường Điều dưỡng - Kỹ thuật Y học",
+    "Thư viện": "Thư viện",
+    "Tạp chí Y học": "Tạp chí Y học",
+    "YHCT": "Khoa Y học Cổ truyền",
+    "HTQT": "Phòng Hợp tác Quốc tế",
+    "TT.ĐTNLYT": "Trung tâm ĐT Nhân lực Y tế"
+}
+
+# ----- Danh mục đơn vị: bí danh (chuẩn hóa) → mã → tên -----
+# Mặc định từ DON_VI_MAP + DON_VI_TEN_DAY_DU; worksheet UNIT_CONFIG_WORKSHEET (nếu có) bổ sung/ghi đè,
+# cột: Tên đơn vị | Mã đơn vị | Tên đầy đủ | Bí danh (cách nhau bởi dấu phẩy/chấm phẩy)
+UNIT_CONFIG_WORKSHEET = "DonVi"
+
+@lru_cache(maxsize=4096)
+def unit_key(name) -> str:
+    """Khóa so khớp tên đơn vị: NFKC, bỏ NBSP, thống nhất Đ/Ð/đ, gộp khoảng trắng, viết hoa."""
+    s = "" if name is None else str(name)
+    s = unicodedata.normalize("NFKC", s.replace("\xa0", " "))
+    s = s.replace("Ð", "Đ").replace("đ", "Đ")
+    return re.sub(r"\s+", " ", s).strip().upper()
+
+def _fallback_unit_code(key: str) -> str:
+    """Đơn vị chưa có trong danh mục: tạm lấy 3 chữ cái đầu (bỏ dấu Đ)."""
+    return re.sub(r"[^A-Z]", "", key.replace("Đ", "D"))[:3]
+
+def build_unit_registry(extra_rows=()) -> dict:
+    """
+    Dựng danh mục đơn vị:
+    - alias: unit_key(tên / tên đầy đủ / mã / bí danh) → mã
+    - name : mã → tên đơn vị (tên ngắn)
+    - full : mã → tên đầy đủ
+    """
+    alias, name, full = {}, {}, {}
+    rows = [{"Tên đơn vị": n, "Mã đơn vị": c, "Tên đầy đủ": DON_VI_TEN_DAY_DU.get(n, n)} for n, c in DON_VI_MAP.items()]
+    for r in list(rows) + list(extra_rows):
+        code = str(r.get("Mã đơn vị", "") or "").strip().upper()
+        short = re.sub(r"\s+", " ", str(r.get("Tên đơn vị", "") or "")).strip()
+        if not code or not short:
+            continue
+        name[code] = short
+        full[code] = str(r.get("Tên đầy đủ", "") or "").strip() or full.get(code) or short
+        others = re.split(r"[,;]", str(r.get("Bí danh", "") or ""))
+        for a in [code, short, full[code], *others]:
+            k = unit_key(a)
+            if k:
+                alias[k] = code
+    version = hashlib.sha1(json.dumps([alias, full], sort_keys=True, ensure_ascii=False).encode()).hexdigest()[:12]
+    return {"alias": alias, "name": name, "full": full, "version": version}
+
+UNIT_REGISTRY = build_unit_registry()
+
+def resolve_unit_codes(names: pd.Series, codes_cur: pd.Series = None, registry: dict = None,
+                       fallback: bool = False) -> pd.Series:
+    """
+    Tên đơn vị → mã cho cả cột: chỉ chuẩn hóa trên các giá trị khác nhau (factorize) rồi ánh xạ lại.
+    - codes_cur: mã đang có (không rỗng thì giữ, viết hoa)
+    - fallback: tên lạ → 3 chữ cái đầu; False → để rỗng
+    """
+    reg = registry or unit_registry()
+    codes, uniq = pd.factorize(names)
+    res = []
+    for u in uniq:
+        k = unit_key(u)
+        res.append(reg["alias"].get(k) or (_fallback_unit_code(k) if fallback and k else ""))
+    # mã -1 (NaN) → phần tử cuối ""
+    out = pd.Series(pd.Series(res + [""], dtype=object).to_numpy()[codes], index=names.index, dtype=object)
+    if codes_cur is not None:
+        cur = codes_cur.astype(object).where(codes_cur.notna(), "").astype(str).str.upper().str.strip()
+        out = cur.where(cur != "", out)
+    return out
+
+# Cột ít giá trị khác nhau → lưu dạng category cho gọn bộ nhớ
+CATEGORY_COLUMNS = ["Tên đơn vị", "Mã đơn vị", "Chức vụ"]
+
+# pandas 2.x: bật Copy-on-Write để lọc/chọn cột trên bảng dùng chung là view, không copy
+# (pandas >= 3 luôn bật sẵn)
+if pd.__version__.startswith("2."):
+    pd.set_option("mode.copy_on_write", True)
 
 # Sheet/Worksheet dùng cố định
 SHEET_ID = "1a_pMNiQbD5yO58abm4EfNMz7AbQTBmG8QV3yEN500uc"
 WORKSHEET_NAME = "Sheet1"  # đúng tên sheet trong gg sheet
+META_WORKSHEET = "_meta"   # ô A1 giữ phiên bản dữ liệu (đồng bộ cache giữa các replica)
 
 # ----- Helpers bảng -----
 def clean_df(df: pd.DataFrame) -> pd.DataFrame:
@@ -70,6 +240,10 @@ def clean_df(df: pd.DataFrame) -> pd.DataFrame:
 def normalize_plate(plate: str) -> str:
     return re.sub(r'[^a-zA-Z0-9]', '', str(plate)).lower()
 
+def normalize_plate_series(s: pd.Series) -> pd.Series:
+    """Bản vector hóa của normalize_plate cho cả cột."""
+    return s.fillna("").astype(str).str.replace(r"[^a-zA-Z0-9]", "", regex=True).str.lower()
+
 def format_name(name: str) -> str:
     return ' '.join(word.capitalize() for word in str(name).strip().split())
 
@@ -79,6 +253,77 @@ def dinh_dang_bien_so(bs: str) -> str:
         return f"{bs[:3]}-{bs[3:6]}.{bs[6:]}"
     return bs
 
+def dinh_dang_bien_so_series(s: pd.Series) -> pd.Series:
+    """Bản vector hóa của dinh_dang_bien_so cho cả cột."""
+    bs = s.fillna("").astype(str).str.upper().str.replace(r"[^A-Z0-9]", "", regex=True)
+    fmt = bs.str[:3] + "-" + bs.str[3:6] + "." + bs.str[6:]
+    return fmt.where(bs.str.len() == 8, bs)
+
+def compact_df(raw: pd.DataFrame) -> pd.DataFrame:
+    """
+    Bảng xe dạng gọn, dùng chung (chỉ đọc) cho mọi phiên:
+    - đủ REQUIRED_COLUMNS, cột đơn vị/chức vụ dạng category, STT dạng số nguyên (Int64)
+    - Mã thẻ chuẩn hóa tại chỗ (viết hoa, bỏ khoảng trắng) – không giữ thêm cột bản sao
+    - cột phụ tính sẵn duy nhất: __plate_norm (biển số chuẩn hóa)
+    Bộ nhớ đo lúc nạp (attrs): "raw_bytes" – bảng gốc theo cột; "legacy_session_bytes" – mỗi phiên kiểu cũ
+    (bản riêng trong session + bản df.copy() của trang kèm cột biển số chuẩn hóa).
+    """
+    raw = clean_df(raw)
+    raw_bytes = raw.memory_usage(deep=True, index=False)
+    df = raw.copy()
+    for c in REQUIRED_COLUMNS:
+        if c not in df.columns:
+            df[c] = ""
+    for c in CATEGORY_COLUMNS:
+        df[c] = df[c].fillna("").astype(str).str.strip().astype("category")
+    df["STT"] = pd.to_numeric(df["STT"], errors="coerce").astype("Int64")
+    df["Mã thẻ"] = df["Mã thẻ"].fillna("").astype(str).str.upper().str.strip()
+    df["__plate_norm"] = normalize_plate_series(df["Biển số"])
+    page_copy = raw.assign(**{"Biển số chuẩn hóa": df["__plate_norm"]})
+    df.attrs["legacy_session_bytes"] = int(raw_bytes.sum() + page_copy.memory_usage(deep=True, index=False).sum())
+    df.attrs["raw_bytes"] = raw_bytes.to_dict()
+    df.attrs["loaded_at"] = time.time_ns()  # định danh lần nạp – làm khóa cache cho các view
+    return df
+
+def filter_sort_positions(df: pd.DataFrame, units=(), roles=(), plate_prefix: str = "",
+                          sort_col: str = "STT", ascending: bool = True):
+    """Lọc (đơn vị, chức vụ, đầu biển số) + sắp xếp trên bảng gọn → mảng vị trí dòng."""
+    mask = pd.Series(True, index=df.index)
+    if units:
+        mask &= df["Tên đơn vị"].isin(units)
+    if roles:
+        mask &= df["Chức vụ"].isin(roles)
+    prefix = normalize_plate(plate_prefix)
+    if prefix:
+        mask &= df["__plate_norm"].str.startswith(prefix)
+    sub = df.loc[mask]
+    if sort_col == "STT":
+        key = pd.to_numeric(sub["STT"], errors="coerce")
+    elif sort_col == "Biển số":
+        key = sub["__plate_norm"]
+    else:
+        key = sub[sort_col]
+    order = key.sort_values(ascending=ascending, kind="stable", na_position="last").index
+    return df.index.get_indexer(order)
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def list_view_positions(loaded_at: int, units: tuple, roles: tuple, plate_prefix: str,
+                        sort_col: str, ascending: bool, _df: pd.DataFrame):
+    """Cache kết quả lọc/sắp xếp theo lần nạp bảng (_df không bị hash)."""
+    return filter_sort_positions(_df, units, roles, plate_prefix, sort_col, ascending)
+
+def public_cols(df: pd.DataFrame) -> list:
+    """Các cột hiển thị (bỏ cột phụ '__…')."""
+    return [c for c in df.columns if not str(c).startswith("__")]
+
+def memory_report(df: pd.DataFrame) -> pd.DataFrame:
+    """So sánh dung lượng từng cột: bảng gốc (object) và bảng gọn đang dùng chung."""
+    raw = pd.Series(df.attrs.get("raw_bytes", {}), dtype="int64")
+    now = df.memory_usage(deep=True, index=False)
+    rep = pd.DataFrame({"Gốc (KB)": raw, "Gọn (KB)": now}).fillna(0) / 1024
+    rep["Kiểu"] = df.dtypes.astype(str).reindex(rep.index).fillna("")
+    return rep.round(1)
+
 def _df_to_values(df, columns):
     vals = []
     for _, r in df.iterrows():
@@ -133,22 +378,17 @@ def resolve_ma_don_vi(ten_dv: str, ma_dv_cur: str = "") -> str:
     """Luôn trả mã đơn vị nếu tên đơn vị hợp lệ; nếu chưa có trong map thì tạo tạm 3 ký tự đầu."""
     if str(ma_dv_cur).strip():
         return str(ma_dv_cur).strip().upper()
-    name = str(ten_dv).strip()
-    if not name:
+    k = unit_key(ten_dv)
+    if not k:
         return ""
-    ma = DON_VI_MAP.get(name)
-    if ma:
-        return ma.upper()
-    # fallback: lấy 3 chữ cái đầu (viết hoa, bỏ dấu)
-    name_ascii = re.sub(r"[^A-Z]", "", re.sub(r"Đ", "D", name.upper()))
-    return name_ascii[:3] if name_ascii else ""
+    return unit_registry()["alias"].get(k) or _fallback_unit_code(k)
 
 
 def build_unit_counters(df_cur: pd.DataFrame) -> dict:
     counters = {}
     if "Mã thẻ" in df_cur.columns:
         for val in df_cur["Mã thẻ"].dropna().astype(str):
-            m = re.match(r"^([A-Z]{3})(\d{3})$", val.strip().upper())
+            m = re.match(r"^([A-Z]{2,3})(\d{3})$", val.strip().upper())
             if m:
                 unit, num = m.group(1), int(m.group(2))
                 counters[unit] = max(counters.get(unit, 0), num)
@@ -172,7 +412,7 @@ def assign_codes_for_row(row: pd.Series, counters: dict) -> pd.Series:
     return row
 def fill_missing_codes_strict(df_new: pd.DataFrame, df_cur: pd.DataFrame) -> pd.DataFrame:
     """
-    - Tự gán 'Mã đơn vị' từ 'Tên đơn vị' (theo DON_VI_MAP). Nếu không map được → để rỗng.
+    - Tự gán 'Mã đơn vị' từ 'Tên đơn vị' (theo danh mục đơn vị). Nếu không map được → để rỗng.
     - Tự sinh 'Mã thẻ' theo từng 'Mã đơn vị' (giữ lại mã đã có đúng format).
     - Seed số chạy dựa trên df_cur hiện có.
     """
@@ -185,22 +425,13 @@ def fill_missing_codes_strict(df_new: pd.DataFrame, df_cur: pd.DataFrame) -> pd.
     df = df.fillna("")
 
     # 1) Mã đơn vị
-    def _resolve_unit(row):
-        ma_cur = str(row.get("Mã đơn vị", "")).strip().upper()
-        if ma_cur:
-            return ma_cur
-        name = str(row.get("Tên đơn vị", "")).strip()
-        if not name:
-            return ""
-        return DON_VI_MAP.get(name, "").upper()
-
-    df["Mã đơn vị"] = df.apply(_resolve_unit, axis=1)
+    df["Mã đơn vị"] = resolve_unit_codes(df["Tên đơn vị"], df["Mã đơn vị"])
 
     # 2) Mã thẻ theo từng đơn vị (seed từ dữ liệu đang có)
     counters = build_unit_counters(df_cur)
 
-    def _gen_codes(group: pd.DataFrame) -> pd.Series:
-        unit = str(group.name or "").strip().upper()
+    def _gen_codes(unit, group: pd.DataFrame) -> pd.Series:
+        unit = str(unit or "").strip().upper()
         if not unit:
             # không có đơn vị → trả nguyên giá trị (nhưng đổi NaN -> rỗng)
             return group["Mã thẻ"].astype(str).replace({"nan": ""})
@@ -219,7 +450,10 @@ def fill_missing_codes_strict(df_new: pd.DataFrame, df_cur: pd.DataFrame) -> pd.
         counters[unit] = cur
         return pd.Series(out, index=group.index)
 
-    df["Mã thẻ"] = df.groupby("Mã đơn vị", dropna=False, group_keys=False).apply(_gen_codes)
+    # lặp nhóm tường minh: groupby.apply trả DataFrame khi chỉ có 1 đơn vị
+    groups = [_gen_codes(u, g) for u, g in df.groupby("Mã đơn vị", dropna=False, sort=False)]
+    if groups:
+        df["Mã thẻ"] = pd.concat(groups)
 
     # 3) Chuẩn hoá STT (nếu muốn)
     try:
@@ -234,6 +468,210 @@ def reindex_stt(df: pd.DataFrame) -> pd.DataFrame:
     df["STT"] = list(range(1, len(df) + 1))
     return df
 
+def _keyify(d: pd.DataFrame) -> pd.Series:
+    """Khóa so khớp: Mã thẻ (viết hoa), nếu trống thì dùng biển số chuẩn hóa."""
+    key = d["Mã thẻ"].astype(str).str.upper().str.strip() if "Mã thẻ" in d.columns else pd.Series([""]*len(d), index=d.index, dtype=object)
+    no_card = key == ""
+    if no_card.any() and "Biển số" in d.columns:
+        # chỉ chuẩn hóa biển số cho dòng chưa có mã thẻ
+        key = key.copy()
+        key[no_card] = normalize_plate_series(d.loc[no_card, "Biển số"])
+    return key
+
+def match_existing_cards(df_new: pd.DataFrame, df_cur: pd.DataFrame) -> pd.DataFrame:
+    """
+    Dòng tải lên chưa có Mã thẻ mà biển số (chuẩn hóa) đã có trên sheet → dùng lại Mã thẻ trên sheet,
+    để so khớp đúng dòng cũ thay vì sinh mã mới rồi thêm trùng biển số.
+    """
+    df = df_new.copy()
+    no_card = df["Mã thẻ"].fillna("").astype(str).str.strip().eq("")
+    if not no_card.any() or df_cur.empty:
+        return df
+    lookup = pd.Series(
+        df_cur["Mã thẻ"].fillna("").astype(str).str.upper().str.strip().to_numpy(),
+        index=normalize_plate_series(df_cur["Biển số"]).to_numpy(),
+    )
+    lookup = lookup[(lookup.index != "") & (lookup != "")]
+    lookup = lookup[~lookup.index.duplicated(keep="last")]
+    df.loc[no_card, "Mã thẻ"] = normalize_plate_series(df.loc[no_card, "Biển số"]).map(lookup).fillna("")
+    return df
+
+def diff_upload(df_cur: pd.DataFrame, df_new: pd.DataFrame, columns=None, ignore=("STT",)) -> dict:
+    """
+    So khớp bản tải lên với sheet hiện tại theo khóa _keyify (hash join qua merge, không lặp từng dòng).
+    Trả dict gồm:
+    - 'insert'    : dòng chưa có trên sheet
+    - 'update'    : dòng có thay đổi, kèm '__ROW__' (số dòng trên sheet) và '__FIELDS__' (các cột đổi)
+    - 'unchanged' : dòng trùng khớp hoàn toàn (bỏ qua khi ghi)
+    - 'duplicate' : dòng trùng khóa trong chính tệp tải lên (giữ dòng cuối cùng, giống upsert cũ)
+    - 'changes'   : bảng chi tiết từng trường thay đổi (Khóa, Dòng, Trường, Cũ, Mới)
+    Cột trong `ignore` (mặc định STT) không tính là thay đổi và giữ nguyên giá trị trên sheet khi cập nhật.
+    """
+    if columns is None:
+        columns = REQUIRED_COLUMNS
+    cmp_cols = [c for c in columns if c not in ignore]
+
+    cur = df_cur.reindex(columns=columns).fillna("").astype(str)
+    new = df_new.reindex(columns=columns).fillna("").astype(str)
+    cur["__KEY__"] = _keyify(cur)
+    cur["__ROW__"] = range(2, len(cur) + 2)  # + header
+    new["__KEY__"] = _keyify(new)
+
+    has_key = new["__KEY__"] != ""
+    dup_mask = has_key & new["__KEY__"].duplicated(keep="last")
+    duplicates = new[dup_mask].drop(columns="__KEY__")
+    new = new[~dup_mask]
+
+    # Sheet có khóa trùng → lấy dòng cuối (đúng như dict key_to_row trước đây)
+    cur = cur[cur["__KEY__"] != ""].drop_duplicates("__KEY__", keep="last")
+    merged = new.merge(
+        cur[["__KEY__", "__ROW__"] + list(columns)].rename(columns={c: f"{c}__cur" for c in columns}),
+        on="__KEY__", how="left", indicator=True,
+    )
+    merged.index = new.index
+
+    found = merged["_merge"].eq("both")
+    inserts = merged.loc[~found, columns]
+
+    matched = merged[found]
+    ne = pd.DataFrame(
+        {c: matched[c].to_numpy() != matched[f"{c}__cur"].to_numpy() for c in cmp_cols},
+        index=matched.index,
+    )
+    changed = ne.any(axis=1)
+    unchanged = matched.loc[~changed, columns]
+
+    upd = matched[changed]
+    ne = ne[changed]
+    updates = upd[columns].copy()
+    for c in columns:
+        if c in ignore:
+            updates[c] = upd[f"{c}__cur"]
+    updates["__ROW__"] = upd["__ROW__"].astype(int)
+    updates["__FIELDS__"] = ne.dot(pd.Index(cmp_cols) + ", ").str.rstrip(", ") if len(ne) else ""
+
+    # Bảng chi tiết thay đổi (long format)
+    stacked = ne.stack()
+    stacked = stacked[stacked]
+    idx, fields = stacked.index.get_level_values(0), stacked.index.get_level_values(1)
+    old_vals = upd[[f"{c}__cur" for c in cmp_cols]].set_axis(cmp_cols, axis=1).stack()
+    new_vals = upd[cmp_cols].stack()
+    changes = pd.DataFrame({
+        "Khóa": upd.loc[idx, "__KEY__"].to_numpy(),
+        "Dòng": upd.loc[idx, "__ROW__"].astype(int).to_numpy(),
+        "Trường": fields,
+        "Cũ": old_vals.loc[stacked.index].to_numpy(),
+        "Mới": new_vals.loc[stacked.index].to_numpy(),
+    })
+
+    return {
+        "insert": inserts, "update": updates, "unchanged": unchanged,
+        "duplicate": duplicates, "changes": changes,
+    }
+
+def write_row_groups(ws, rows, columns=None):
+    """Ghi các dòng (số dòng sheet, payload) theo cụm liên tiếp → mỗi cụm 1 lệnh update."""
+    if columns is None:
+        columns = REQUIRED_COLUMNS
+    last_col = chr(ord("A") + len(columns) - 1)
+    rows = sorted(rows, key=lambda x: x[0])
+    grp, prev, calls = [], None, 0
+    for rownum, payload in rows:
+        if prev is not None and rownum != prev + 1:
+            gs_retry(ws.update, f"A{grp[0][0]}:{last_col}{grp[-1][0]}", [p for _, p in grp])
+            calls += 1
+            grp = []
+        grp.append((rownum, payload))
+        prev = rownum
+    if grp:
+        gs_retry(ws.update, f"A{grp[0][0]}:{last_col}{grp[-1][0]}", [p for _, p in grp])
+        calls += 1
+    return calls
+
+def simulate_import(df_cur: pd.DataFrame, df_new: pd.DataFrame, diff: dict, mode: str):
+    """Dựng bảng kết quả sau khi nhập (không ghi sheet) → (bảng, danh sách số dòng bị tác động)."""
+    cur = df_cur.reindex(columns=REQUIRED_COLUMNS).fillna("").astype(str).reset_index(drop=True)
+    if mode.startswith("Thay thế"):
+        res = df_new.reindex(columns=REQUIRED_COLUMNS).reset_index(drop=True)
+        return res, list(range(2, len(res) + 2))
+    if mode.startswith("Thêm"):
+        added = df_new
+        touched = []
+    else:
+        upd = diff["update"]
+        if not upd.empty:
+            cur.iloc[(upd["__ROW__"] - 2).to_numpy(), :] = upd[REQUIRED_COLUMNS].to_numpy()
+        added = diff["insert"]
+        touched = upd["__ROW__"].tolist()
+    res = pd.concat([cur, added.reindex(columns=REQUIRED_COLUMNS)], ignore_index=True)
+    touched += list(range(len(cur) + 2, len(res) + 2))
+    return res, touched
+
+PHONE_RE = r"0\d{9,10}"
+EMAIL_RE = r"[^@\s]+@[^@\s]+\.[^@\s]+"
+
+def scan_data_quality(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Kiểm tra chất lượng toàn bộ bảng (vector hóa, không lặp từng dòng).
+    Trả bảng lỗi dạng dài: Dòng (số dòng trên sheet), Mã thẻ, Biển số, Lỗi, Chi tiết.
+    - Trùng biển số (sau chuẩn hóa)
+    - Mã thẻ trùng / sai định dạng / không khớp Mã đơn vị
+    - Mã đơn vị không khớp Tên đơn vị theo danh mục đơn vị, tên đơn vị lạ
+    - Số điện thoại / Email không hợp lệ
+    """
+    cols = ["Dòng", "Mã thẻ", "Biển số", "Lỗi", "Chi tiết"]
+    if df is None or df.empty:
+        return pd.DataFrame(columns=cols)
+    d = df.reindex(columns=[c for c in REQUIRED_COLUMNS if c != "STT"]).fillna("").astype(str)  # STT (Int64) không cần kiểm tra
+
+    def per_unique(col, fn):
+        # Cột ít giá trị khác nhau (đơn vị…) → chỉ xử lý trên giá trị duy nhất rồi ánh xạ lại
+        codes, uniq = pd.factorize(d[col])
+        return pd.Series(fn(pd.Series(uniq, dtype=object)).to_numpy()[codes], index=d.index)
+
+    plate = df["__plate_norm"].astype(str) if "__plate_norm" in df.columns else normalize_plate_series(d["Biển số"])
+    card = d["Mã thẻ"].str.upper().str.strip()
+    card_ok = card.str.fullmatch(CARD_RE)
+    unit_code = per_unique("Mã đơn vị", lambda u: u.str.upper().str.strip())
+    unit_name = per_unique("Tên đơn vị", lambda u: u.str.strip())
+    expected = resolve_unit_codes(df["Tên đơn vị"] if "Tên đơn vị" in df.columns else d["Tên đơn vị"])
+    phone = d["Số điện thoại"].str.replace(r"[\s.\-]", "", regex=True)
+    email = d["Email"].str.strip()
+
+    # (mặt nạ lỗi, nhãn, hàm sinh chi tiết chỉ trên các dòng lỗi)
+    checks = [
+        (plate.ne("") & plate.duplicated(keep=False), "Trùng biển số", lambda m: plate[m]),
+        (plate.eq(""), "Thiếu biển số", lambda m: d.loc[m, "Họ tên"]),
+        (card.ne("") & card.duplicated(keep=False), "Trùng mã thẻ", lambda m: card[m]),
+        (card.ne("") & ~card_ok, "Mã thẻ sai định dạng", lambda m: card[m]),
+        (card_ok & unit_code.ne("") & card.str[:-3].ne(unit_code),
+         "Mã thẻ không khớp mã đơn vị", lambda m: card[m].str[:-3] + " ≠ " + unit_code[m]),
+        (expected.ne("") & unit_code.ne(expected), "Mã đơn vị không khớp tên đơn vị",
+         lambda m: unit_name[m] + " → " + expected[m] + " (đang là " + unit_code[m] + ")"),
+        (unit_name.ne("") & expected.eq(""), "Tên đơn vị không có trong danh mục", lambda m: unit_name[m]),
+        (phone.ne("") & ~phone.str.fullmatch(PHONE_RE), "Số điện thoại không hợp lệ", lambda m: d.loc[m, "Số điện thoại"]),
+        (email.ne("") & ~email.str.fullmatch(EMAIL_RE), "Email không hợp lệ", lambda m: email[m]),
+    ]
+    parts = []
+    for mask, label, detail in checks:
+        mask = mask.fillna(False).astype(bool)
+        if mask.any():
+            parts.append(pd.DataFrame({
+                "Dòng": d.index[mask] + 2,
+                "Mã thẻ": d.loc[mask, "Mã thẻ"].to_numpy(),
+                "Biển số": d.loc[mask, "Biển số"].to_numpy(),
+                "Lỗi": label,
+                "Chi tiết": detail(mask).to_numpy(),
+            }))
+    if not parts:
+        return pd.DataFrame(columns=cols)
+    return pd.concat(parts, ignore_index=True)
+
+@st.cache_data(max_entries=8, show_spinner=False)
+def scan_data_quality_cached(version: str, _df: pd.DataFrame) -> pd.DataFrame:
+    """Cache kết quả kiểm tra theo lần nạp bảng (_df không bị hash)."""
+    return scan_data_quality(_df)
+
 def make_qr_bytes(url: str) -> bytes:
     img = qrcode.make(url)
     buf = BytesIO()
@@ -246,6 +684,7 @@ def make_qr_bytes(url: str) -> bytes:
 # ==========================
 from google.oauth2.service_account import Credentials
 
+@st.cache_resource(show_spinner=False)
 def get_sheet():
     """Mở đúng SHEET_ID + tab WORKSHEET_NAME; tự tạo header nếu sheet mới."""
     info = st.secrets["google_service_account"]
@@ -270,11 +709,28 @@ def get_sheet():
         gs_retry(ws.update, "A1", [REQUIRED_COLUMNS])
     return ws
 
-try:
-    ws = get_sheet()
-except Exception as e:
-    st.error(f"❌ Lỗi mở Google Sheet: {e}")
-    st.stop()
+@st.cache_resource(ttl=300, show_spinner=False)
+def load_unit_registry() -> dict:
+    """Danh mục mặc định + worksheet UNIT_CONFIG_WORKSHEET (nếu có) → thêm đơn vị không cần deploy lại."""
+    try:
+        rows = gs_retry(get_sheet().spreadsheet.worksheet(UNIT_CONFIG_WORKSHEET).get_all_records)
+    except Exception:
+        rows = []
+    return build_unit_registry(rows)
+
+def unit_registry() -> dict:
+    try:
+        return load_unit_registry()
+    except Exception:
+        return UNIT_REGISTRY
+
+def open_sheet_or_stop():
+    # Chỉ mở sheet khi thật sự cần dữ liệu (sau khi qua cổng mật khẩu QR)
+    try:
+        return get_sheet()
+    except Exception as e:
+        st.error(f"❌ Lỗi mở Google Sheet: {e}")
+        st.stop()
 
 # ==========================
 # BẢO VỆ – MẬT KHẨU
@@ -284,21 +740,381 @@ if not APP_PASSWORD:
     st.error("❌ Thiếu mật khẩu ứng dụng trong secrets (app_password hoặc qr_password).")
     st.stop()
 
+# ==========================
+# PHIÊN BẢN DỮ LIỆU (đồng bộ cache giữa các replica/phiên)
+# ==========================
+# Mỗi lần ghi → đổi "phiên bản"; mọi replica chỉ đọc phiên bản (1 ô / 1 dòng SQLite) tối đa 1 lần/giây
+# và chỉ nạp lại toàn bảng khi phiên bản đổi.
+# - Mặc định: ô A1 của worksheet META_WORKSHEET trên cùng Google Sheet
+# - secrets["cache_version_file"]: dùng file SQLite cục bộ (các replica cùng máy / chạy thử local)
+VERSION_FILE = _get_secret("cache_version_file")
+# Khoảng giữa 2 lần đọc phiên bản / replica. SQLite cục bộ: 1s. Google Sheets: mặc định 5s vì mọi replica
+# dùng chung 1 service account (quota đọc 60 lệnh/phút/user) – đặt cache_probe_seconds ≈ số replica trở lên.
+try:
+    VERSION_PROBE_SECONDS = float(_get_secret("cache_probe_seconds") or (1 if VERSION_FILE else 5))
+except ValueError:
+    VERSION_PROBE_SECONDS = 1.0 if VERSION_FILE else 5.0
+VERSION_PROBE_TIMEOUT = 1.5  # giây chờ tối đa mỗi lần đọc; quá hạn → dùng phiên bản đã biết
+
+@st.cache_resource(show_spinner=False)
+def get_meta_sheet():
+    try:
+        return get_sheet().spreadsheet.worksheet(META_WORKSHEET)
+    except gspread.WorksheetNotFound:
+        ws_meta = get_sheet().spreadsheet.add_worksheet(title=META_WORKSHEET, rows="2", cols="2")
+        gs_retry(ws_meta.update, "A1", [[new_data_version()]])
+        return ws_meta
+
+def new_data_version() -> str:
+    return f"{time.time_ns():x}-{random.randrange(1 << 16):04x}"
+
+def _sqlite_version(path: str, new: str = "") -> str:
+    con = sqlite3.connect(path, timeout=5)
+    try:
+        with con:
+            con.execute("CREATE TABLE IF NOT EXISTS meta (k TEXT PRIMARY KEY, v TEXT)")
+            if new:
+                con.execute("INSERT OR REPLACE INTO meta (k, v) VALUES ('data_version', ?)", (new,))
+        row = con.execute("SELECT v FROM meta WHERE k = 'data_version'").fetchone()
+        return row[0] if row else ""
+    finally:
+        con.close()
+
+def read_data_version(ws_meta=None) -> str:
+    """Đọc 1 lần, KHÔNG retry (lỗi/quota → để probe dùng phiên bản đã biết)."""
+    if VERSION_FILE:
+        return _sqlite_version(VERSION_FILE)
+    return str((ws_meta or get_meta_sheet()).acell("A1").value or "")
+
+@st.cache_resource(show_spinner=False)
+def _version_probe_state() -> dict:
+    # 1 luồng đọc duy nhất/tiến trình: lệnh đang treo không bị gửi chồng thêm
+    return {"lock": threading.Lock(), "last": "", "future": None, "pool": ThreadPoolExecutor(max_workers=1)}
+
+def bump_data_version() -> str:
+    """Gọi sau mỗi lần ghi sheet để các replica/phiên khác nạp lại."""
+    v = new_data_version()
+    if VERSION_FILE:
+        _sqlite_version(VERSION_FILE, v)
+    else:
+        gs_retry(get_meta_sheet().update, "A1", [[v]])
+    state = _version_probe_state()
+    with state["lock"]:
+        state["last"] = v
+    return v
+
+@st.cache_data(ttl=VERSION_PROBE_SECONDS, show_spinner=False)
+def probe_data_version() -> str:
+    """
+    Phiên bản hiện tại (cache ngắn). Đọc 1 lần, chờ tối đa VERSION_PROBE_TIMEOUT giây;
+    lỗi/quá hạn → trả phiên bản đã biết gần nhất (không đổi khóa cache → không nạp lại toàn bảng).
+    """
+    state = _version_probe_state()
+    try:
+        ws_meta = None if VERSION_FILE else get_meta_sheet()
+    except Exception:
+        return state["last"]
+    with state["lock"]:
+        if state["future"] is None:
+            state["future"] = state["pool"].submit(read_data_version, ws_meta)
+        fut = state["future"]
+    try:
+        v = fut.result(timeout=VERSION_PROBE_TIMEOUT)
+    except Exception:
+        # còn treo → lần probe sau chờ tiếp chính lệnh này; đã lỗi → lần sau gửi lệnh mới
+        if fut.done():
+            with state["lock"]:
+                state["future"] = None
+        return state["last"]
+    with state["lock"]:
+        state["future"] = None
+        state["last"] = v
+    return v
+
 # ==========================
 # LOAD DỮ LIỆU CHÍNH
 # ==========================
-@st.cache_data(ttl=60)
-def load_df():
+@st.cache_resource(ttl=60, max_entries=2, show_spinner=False)
+def fetch_df(version: str = ""):
+    """
+    Bảng xe gọn (compact_df) giữ 1 bản/tiến trình, mọi phiên dùng chung – KHÔNG sửa trực tiếp.
+    Khóa cache theo `version` (probe_data_version); ttl 60s vẫn giữ cho trường hợp sửa tay trên Google Sheets.
+    Lỗi được ném ra (không cache) để nơi gọi tự xử lý.
+    """
+    # Giữ nguyên chuỗi (không đổi "0912345678" thành số 912345678)
+    data = get_sheet().get_all_records(numericise_ignore=["all"])
+    return compact_df(pd.DataFrame(data))
+
+def load_df(version: str = ""):
+    """fetch_df, lỗi thì báo & dừng trang."""
     try:
-        data = ws.get_all_records()
-        return pd.DataFrame(data)
+        return fetch_df(version)
     except Exception as e:
         st.error(f"❌ Không thể tải dữ liệu xe: {e}")
         st.stop()
 
+# ==========================
+# NHẬT KÝ CỔNG (mỗi lần quét QR hợp lệ = 1 lượt vào/ra)
+# ==========================
+# Ghi ngay vào file JSONL cục bộ (append-only) rồi đẩy phần chưa gửi lên worksheet GATE_LOG_WORKSHEET
+# bằng 1 lệnh append_rows khi đủ GATE_FLUSH_ROWS dòng, hoặc theo luồng nền mỗi GATE_FLUSH_SECONDS giây.
+GATE_LOG_ENABLED = _get_secret("gate_log").strip().lower() in ("1", "true", "yes", "on")
+GATE_LOG_FILE = _get_secret("gate_log_file") or "gate_log.jsonl"
+GATE_ID_DEFAULT = _get_secret("gate_id") or "main"
+GATE_LOG_WORKSHEET = "GateLog"
+GATE_LOG_COLUMNS = ["Thời gian", "Mã thẻ", "Biển số", "Cổng"]
+GATE_FLUSH_ROWS = 50
+GATE_FLUSH_SECONDS = 30
+LOCAL_TZ = ZoneInfo("Asia/Ho_Chi_Minh")
+
+GATE_FLUSH_MAX_ROWS = 5000  # tối đa mỗi lệnh append_rows
+GATE_SENT_FILE = GATE_LOG_FILE + ".sent"  # vị trí (byte) đã đẩy lên sheet trong GATE_LOG_FILE
+
+@st.cache_resource(show_spinner=False)
+def gate_log_state() -> dict:
+    """Khóa ghi file & khóa đẩy lên sheet, dùng chung cho mọi phiên trong tiến trình."""
+    return {"file_lock": threading.Lock(), "flush_lock": threading.Lock()}
+
+@st.cache_resource(show_spinner=False)
+def get_gate_log_sheet():
+    try:
+        return get_sheet().spreadsheet.worksheet(GATE_LOG_WORKSHEET)
+    except gspread.WorksheetNotFound:
+        ws_log = get_sheet().spreadsheet.add_worksheet(title=GATE_LOG_WORKSHEET, rows="1000", cols=str(len(GATE_LOG_COLUMNS)))
+        gs_retry(ws_log.update, "A1", [GATE_LOG_COLUMNS])
+        return ws_log
+
+def _read_sent_offset() -> int:
+    try:
+        with open(GATE_SENT_FILE, encoding="utf-8") as f:
+            return int(f.read().strip() or 0)
+    except (OSError, ValueError):
+        return 0
+
+def _write_sent_offset(offset: int) -> None:
+    tmp = GATE_SENT_FILE + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(str(offset))
+    os.replace(tmp, GATE_SENT_FILE)  # ghi nguyên tử
+
+def _unsent_gate_rows(offset: int):
+    """Các dòng JSONL hoàn chỉnh sau `offset` → (rows, offset mới)."""
+    state = gate_log_state()
+    with state["file_lock"]:
+        try:
+            with open(GATE_LOG_FILE, "rb") as f:
+                f.seek(offset)
+                chunk = f.read()
+        except OSError:
+            return [], offset
+    rows, pos = [], offset
+    for line in chunk.splitlines(keepends=True):
+        if not line.endswith(b"\n") or len(rows) >= GATE_FLUSH_MAX_ROWS:
+            break  # dòng đang ghi dở / đủ 1 lô
+        pos += len(line)
+        try:
+            ev = json.loads(line)
+        except ValueError:
+            continue  # dòng hỏng: bỏ qua nhưng vẫn tính là đã xử lý
+        rows.append([str(ev.get(c, "")) for c in GATE_LOG_COLUMNS])
+    return rows, pos
+
+def flush_gate_log(force: bool = False, blocking: bool = True) -> int:
+    """
+    Đẩy các dòng chưa gửi trong GATE_LOG_FILE lên sheet (1 lệnh API/lô), rồi mới lưu vị trí đã gửi.
+    Không `force` → chỉ gửi khi đủ GATE_FLUSH_ROWS dòng (gửi theo thời gian là việc của luồng nền).
+    `blocking=False` → đang có lần gửi khác thì bỏ qua ngay, không chờ.
+    Lỗi → vị trí không đổi, lần sau gửi lại; khởi động lại tiến trình cũng không mất sự kiện.
+    """
+    lock = gate_log_state()["flush_lock"]
+    if not lock.acquire(blocking=blocking):
+        return 0
+    try:
+        rows, pos = _unsent_gate_rows(_read_sent_offset())
+        if not rows or not (force or len(rows) >= GATE_FLUSH_ROWS):
+            return 0
+        gs_retry(get_gate_log_sheet().append_rows, rows, value_input_option="RAW")
+        _write_sent_offset(pos)
+        return len(rows)
+    finally:
+        lock.release()
+
+@st.cache_resource(show_spinner=False)
+def start_gate_log_flusher() -> threading.Thread:
+    """Luồng nền/tiến trình: gửi ngay phần còn tồn khi khởi động, sau đó cứ GATE_FLUSH_SECONDS gửi 1 lần."""
+    def _loop():
+        while True:
+            try:
+                while flush_gate_log(force=True) >= GATE_FLUSH_MAX_ROWS:
+                    pass  # còn tồn nhiều → gửi tiếp lô sau
+            except Exception:
+                pass  # sheet lỗi: giữ nguyên vị trí, lần sau thử lại
+            time.sleep(GATE_FLUSH_SECONDS)
+    t = threading.Thread(target=_loop, name="gate-log-flusher", daemon=True)
+    t.start()
+    return t
+
+def record_gate_event(card: str, plate: str, gate: str) -> None:
+    """Ghi ngay vào file cục bộ (append-only); đủ lô & không có lần gửi nào đang chạy thì đẩy luôn, còn lại để luồng nền gửi."""
+    row = [datetime.now(LOCAL_TZ).strftime("%Y-%m-%d %H:%M:%S"), card, plate, gate]
+    state = gate_log_state()
+    with state["file_lock"]:
+        with open(GATE_LOG_FILE, "a", encoding="utf-8") as f:
+            f.write(json.dumps(dict(zip(GATE_LOG_COLUMNS, row)), ensure_ascii=False) + "\n")
+    try:
+        flush_gate_log(blocking=False)  # lượt quét không bao giờ chờ Sheets đang backoff
+    except Exception:
+        pass  # đã có trong file cục bộ; luồng nền sẽ gửi lại
+
+if GATE_LOG_ENABLED:
+    start_gate_log_flusher()
+
+@st.cache_data(ttl=GATE_FLUSH_SECONDS, show_spinner=False)
+def load_gate_events() -> pd.DataFrame:
+    vals = gs_retry(get_gate_log_sheet().get_all_values)
+    if len(vals) <= 1:
+        return pd.DataFrame(columns=GATE_LOG_COLUMNS)
+    return pd.DataFrame([r[:len(GATE_LOG_COLUMNS)] for r in vals[1:]], columns=GATE_LOG_COLUMNS)
+
+def gate_hourly_stats(events: pd.DataFrame) -> pd.DataFrame:
+    """
+    Thống kê theo giờ từ nhật ký cổng: Lượt quét, Vào, Ra, Xe trong trường (cuối giờ).
+    Mỗi xe (khóa _keyify: Mã thẻ, không có thẻ thì biển số chuẩn hóa) trong một ngày: lượt quét lẻ = vào, chẵn = ra;
+    số xe trong trường tính lại từ 0 mỗi ngày.
+    """
+    cols = ["Giờ", "Lượt quét", "Vào", "Ra", "Xe trong trường"]
+    if events is None or events.empty:
+        return pd.DataFrame(columns=cols)
+    ev = pd.DataFrame({
+        "ts": pd.to_datetime(events["Thời gian"], errors="coerce"),
+        "vehicle": _keyify(events),
+    }).dropna(subset=["ts"]).sort_values("ts", kind="stable")
+    if ev.empty:
+        return pd.DataFrame(columns=cols)
+    ev["day"] = ev["ts"].dt.normalize()
+    ev["in"] = ev.groupby(["day", "vehicle"]).cumcount() % 2 == 0
+    ev["hour"] = ev["ts"].dt.floor("h")
+    g = ev.groupby("hour").agg(scans=("in", "size"), vao=("in", "sum"))
+    g = g.reindex(pd.date_range(g.index.min(), g.index.max(), freq="h"), fill_value=0)
+    g["ra"] = g["scans"] - g["vao"]
+    g["occ"] = (g["vao"] - g["ra"]).groupby(g.index.normalize()).cumsum()
+    out = g.reset_index()
+    out.columns = cols
+    return out
+
 # ====== QR gate: mật khẩu QR riêng & chỉ hiển thị đúng 1 xe rồi dừng ======
 QR_PASSWORD = _get_secret("QR_PASSWORD", "qr_password", "qrpassword", "qr_pwd")  # CHỈ mật khẩu QR
 
+# --- Chống dò mật khẩu QR: giới hạn số lần sai theo client (cửa sổ trượt, LRU giới hạn bộ nhớ) ---
+QR_MAX_FAILS = 5             # số lần sai tối đa trong cửa sổ
+QR_FAIL_WINDOW = 300         # giây
+QR_LIMITER_MAX_CLIENTS = 10000
+try:
+    # số proxy tin cậy đứng trước app – chỉ đặt khi chắc chắn có proxy ghi X-Forwarded-For (Streamlit Cloud / nginx: 1);
+    # mặc định 0 = app nhận kết nối trực tiếp, khi đó X-Forwarded-For hoàn toàn do client tự điền
+    QR_TRUSTED_PROXY_HOPS = int(_get_secret("trusted_proxy_hops") or 0)
+except ValueError:
+    QR_TRUSTED_PROXY_HOPS = 0
+QR_TOKEN_TTL = 8 * 3600      # token sau khi nhập đúng: 1 ca trực
+QR_TOKEN_COOKIE = "qr_token"
+
+@st.cache_resource(show_spinner=False)
+def qr_attempt_store() -> dict:
+    return {"lock": threading.Lock(), "fails": OrderedDict()}
+
+def client_key() -> str:
+    """
+    Địa chỉ client do hạ tầng ghi nhận, KHÔNG tin giá trị client tự gửi:
+    - Sau QR_TRUSTED_PROXY_HOPS proxy tin cậy: lấy phần tử thứ N tính từ PHẢI của X-Forwarded-For
+      (các phần tử bên trái do client tự điền, giả mạo được)
+    - Không có proxy (0) hoặc header thiếu: địa chỉ kết nối st.context.ip_address
+    - Không xác định được → "" (nơi gọi từ chối lượt này; không gom chung 1 khóa vì 1 client sai sẽ khóa mọi người,
+      cũng không dùng id phiên vì mở phiên mới là reset được)
+    """
+    ctx = getattr(st, "context", None)
+    try:
+        if QR_TRUSTED_PROXY_HOPS > 0:
+            hops = [h.strip() for h in (ctx.headers.get("X-Forwarded-For") or "").split(",") if h.strip()]
+            if len(hops) >= QR_TRUSTED_PROXY_HOPS:
+                return hops[-QR_TRUSTED_PROXY_HOPS]
+        ip = getattr(ctx, "ip_address", None)
+        if ip:
+            return str(ip)
+    except Exception:
+        pass
+    return ""
+
+def qr_blocked_for(key: str, now: float = None) -> float:
+    """Số giây còn bị chặn (0 = được thử)."""
+    now = time.time() if now is None else now
+    store = qr_attempt_store()
+    with store["lock"]:
+        fails = store["fails"].get(key)
+        if not fails:
+            return 0.0
+        while fails and fails[0] <= now - QR_FAIL_WINDOW:
+            fails.popleft()
+        if not fails:
+            del store["fails"][key]
+            return 0.0
+        if len(fails) < QR_MAX_FAILS:
+            return 0.0
+        return fails[0] + QR_FAIL_WINDOW - now
+
+def qr_register_fail(key: str, now: float = None) -> None:
+    now = time.time() if now is None else now
+    store = qr_attempt_store()
+    with store["lock"]:
+        fails = store["fails"].setdefault(key, deque(maxlen=QR_MAX_FAILS))
+        fails.append(now)
+        store["fails"].move_to_end(key)
+        while len(store["fails"]) > QR_LIMITER_MAX_CLIENTS:
+            store["fails"].popitem(last=False)
+
+def qr_reset_fails(key: str) -> None:
+    store = qr_attempt_store()
+    with store["lock"]:
+        store["fails"].pop(key, None)
+
+def _qr_token_key() -> bytes:
+    # Khóa riêng nếu có, không thì suy ra từ QR_PASSWORD (đổi mật khẩu → token cũ hết hiệu lực)
+    secret = _get_secret("qr_token_secret") or f"qr-token|{QR_PASSWORD}"
+    return hashlib.sha256(secret.encode("utf-8")).digest()
+
+def make_qr_token(key: bytes, ttl: int = QR_TOKEN_TTL, now: float = None) -> str:
+    exp = int((time.time() if now is None else now) + ttl)
+    sig = hmac.new(key, f"qr|{exp}".encode(), hashlib.sha256).hexdigest()[:32]
+    return f"{exp}.{sig}"
+
+def verify_qr_token(token: str, key: bytes, now: float = None) -> bool:
+    try:
+        exp_s, sig = str(token).split(".", 1)
+        exp = int(exp_s)
+    except ValueError:
+        return False
+    good = hmac.new(key, f"qr|{exp}".encode(), hashlib.sha256).hexdigest()[:32]
+    return hmac.compare_digest(sig.encode("utf-8"), good.encode()) and exp > (time.time() if now is None else now)
+
+def _qr_token_candidates() -> list:
+    """Token từ phiên hiện tại hoặc cookie trình duyệt (không nhận token qua URL)."""
+    out = [st.session_state.get("qr_token", "")]
+    try:
+        out.append(st.context.cookies.get(QR_TOKEN_COOKIE, ""))
+    except Exception:
+        pass
+    return [t for t in out if t]
+
+def _remember_qr_token(token: str) -> None:
+    st.session_state.qr_token = token
+    try:
+        import streamlit.components.v1 as components
+        components.html(
+            f"<script>document.cookie='{QR_TOKEN_COOKIE}={token}; path=/; max-age={QR_TOKEN_TTL}; SameSite=Strict';</script>",
+            height=0,
+        )
+    except Exception:
+        pass
+
 # Lấy id=? tương thích API mới/cũ
 try:
     qp = getattr(st, "query_params", None)
@@ -310,8 +1126,12 @@ qr_id = ""
 if "id" in params:
     v = params["id"]
     qr_id = v[0] if isinstance(v, list) else str(v)
+qr_payload = ""
+if "p" in params:
+    v = params["p"]
+    qr_payload = v[0] if isinstance(v, list) else str(v)
 
-if qr_id:
+if qr_id or qr_payload:
     # Ẩn sidebar khi mở bằng QR
     st.markdown("""
         <style>
@@ -324,36 +1144,98 @@ if qr_id:
     if not QR_PASSWORD:
         st.error("Thiếu QR_PASSWORD trong secrets."); st.stop()
 
-    pwd = st.text_input("🔑 Nhập mật khẩu QR", type="password", placeholder="Mật khẩu chỉ để xem QR")
-    if not pwd:
-        st.info("Vui lòng nhập mật khẩu QR để xem thông tin xe."); st.stop()
-    if pwd.strip() != QR_PASSWORD:
-        st.error("❌ Sai mật khẩu QR."); st.stop()
-
-    # Đúng mật khẩu QR → chỉ hiển thị bản ghi khớp rồi DỪNG
-    df0 = load_df().copy()
-    df0["__plate_norm"] = df0["Biển số"].astype(str).apply(normalize_plate)
-    df0["__card_up"]    = df0.get("Mã thẻ", "").astype(str).str.upper().str.strip()
+    # Đã nhập đúng trước đó (token còn hạn) → bỏ qua bước mật khẩu
+    token_key = _qr_token_key()
+    if not any(verify_qr_token(t, token_key) for t in _qr_token_candidates()):
+        ckey = client_key()
+        if not ckey:
+            st.error("⛔ Không xác định được địa chỉ truy cập – không thể kiểm tra mật khẩu QR lúc này."); st.stop()
+        wait = qr_blocked_for(ckey)
+        if wait > 0:
+            st.error(f"⛔ Nhập sai quá nhiều lần. Thử lại sau {int(wait) + 1} giây."); st.stop()
+        pwd = st.text_input("🔑 Nhập mật khẩu QR", type="password", placeholder="Mật khẩu chỉ để xem QR")
+        if not pwd:
+            st.info("Vui lòng nhập mật khẩu QR để xem thông tin xe."); st.stop()
+        if not hmac.compare_digest(pwd.strip().encode("utf-8"), QR_PASSWORD.encode("utf-8")):
+            qr_register_fail(ckey)
+            st.error("❌ Sai mật khẩu QR."); st.stop()
+        qr_reset_fails(ckey)
+        _remember_qr_token(make_qr_token(token_key))
+
+    # QR ký số: xác thực chữ ký trước; danh bạ vẫn là nguồn chuẩn khi đọc được (xe đã xóa → QR bị thu hồi)
+    signing_key = qr_signing_key()
+    signed = None
+    if qr_payload and not signing_key:
+        st.warning("⚠️ Máy chủ chưa cấu hình khóa ký QR (qr_signing_key) – tra cứu theo danh bạ.")
+    elif qr_payload:
+        signed = verify_qr_payload(qr_payload, signing_key)
+        if signed is None:
+            st.warning("⚠️ QR ký số không hợp lệ hoặc đã hết hạn – tra cứu theo danh bạ.")
+
+    hit = None  # (Mã thẻ, Biển số) của xe tìm thấy
+    if signed:
+        try:
+            df0 = fetch_df(probe_data_version())
+        except Exception:
+            df0 = None  # danh bạ không đọc được → dùng dữ liệu đã ký trong QR
+        if df0 is None:
+            ten_dv = UNIT_REGISTRY["name"].get(signed["Mã đơn vị"], "")  # danh mục tĩnh: không đọc sheet
+            st.success("✅ Thông tin xe (QR ký số – đã xác thực):")
+            st.caption("Không kết nối được danh bạ: hiển thị theo dữ liệu ký trong QR.")
+            st.dataframe(pd.DataFrame([{
+                "Mã thẻ": signed["Mã thẻ"], "Biển số": dinh_dang_bien_so(signed["Biển số"]),
+                "Mã đơn vị": signed["Mã đơn vị"], "Tên đơn vị": ten_dv,
+                "QR hết hạn": datetime.fromtimestamp(signed["Hết hạn"], LOCAL_TZ).strftime("%d/%m/%Y"),
+            }]), hide_index=True, use_container_width=True)
+            hit = (signed["Mã thẻ"], signed["Biển số"])
+        else:
+            # phải khớp cả biển số: thẻ đã cấp lại cho xe khác cũng coi như QR cũ bị thu hồi
+            view = df0[df0["__plate_norm"].eq(normalize_plate(signed["Biển số"]))]
+            if signed["Mã thẻ"]:
+                view = view[view["Mã thẻ"].eq(signed["Mã thẻ"])]
+            if view.empty:
+                st.error("⛔ QR đã bị thu hồi: xe không còn trong danh bạ.")
+            else:
+                st.success("✅ Thông tin xe (QR ký số – đã xác thực):")
+                st.dataframe(view[public_cols(view)], hide_index=True, use_container_width=True)
+                r0 = view.iloc[0]
+                hit = (str(r0["Mã thẻ"]), str(r0["Biển số"]))
+    else:
+        # Đúng mật khẩu QR → chỉ hiển thị bản ghi khớp rồi DỪNG
+        ws = open_sheet_or_stop()
+        df0 = load_df(probe_data_version())
 
-    q_up = str(qr_id).upper().strip()
-    q_norm = normalize_plate(str(qr_id))
+        q_up = str(qr_id).upper().strip()
+        q_norm = normalize_plate(str(qr_id))
 
-    # Ưu tiên khớp MÃ THẺ; nếu không có thì khớp biển số chuẩn hóa
-    if re.fullmatch(r"[A-Z]{3}\d{3}", q_up):
-        view = df0[df0["__card_up"].eq(q_up)]
-    else:
-        view = df0[df0["__plate_norm"].eq(q_norm)]
+        # Ưu tiên khớp MÃ THẺ; nếu không có thì khớp biển số chuẩn hóa
+        if re.fullmatch(CARD_RE, q_up):
+            view = df0[df0["Mã thẻ"].eq(q_up)]
+        else:
+            view = df0[df0["__plate_norm"].eq(q_norm)]
 
-    if view.empty:
-        st.error(f"Không tìm thấy xe với mã/biển số: {qr_id}")
-    else:
-        st.success("✅ Thông tin xe:")
-        st.dataframe(
-            view.drop(columns=["__plate_norm","__card_up"], errors="ignore"),
-            hide_index=True, use_container_width=True
-        )
+        if view.empty:
+            st.error(f"Không tìm thấy xe với mã/biển số: {qr_id}")
+        else:
+            st.success("✅ Thông tin xe:")
+            st.dataframe(
+                view[public_cols(view)],
+                hide_index=True, use_container_width=True
+            )
+            r0 = view.iloc[0]
+            hit = (str(r0["Mã thẻ"]), str(r0["Biển số"]))
+
+    # Ghi 1 lượt vào/ra cho mỗi lần mở QR (không ghi lại khi trang chạy lại trong cùng phiên)
+    scan_id = qr_payload or qr_id
+    if hit and GATE_LOG_ENABLED and st.session_state.get("gate_logged") != scan_id:
+        g = params.get("gate", "")
+        gate = (g[0] if isinstance(g, list) else str(g)).strip() or GATE_ID_DEFAULT
+        record_gate_event(hit[0], hit[1], gate)
+        st.session_state.gate_logged = scan_id
     st.stop()  # BẮT BUỘC: không cho chạy xuống app quản trị
 
+ws = open_sheet_or_stop()
+
 # Cổng đăng nhập app
 if "auth_ok" not in st.session_state:
     st.session_state.auth_ok = False
@@ -373,9 +1255,18 @@ if not st.session_state.auth_ok:
 st.sidebar.image("ump_logo.png", width=120)
 st.sidebar.markdown("---")
 
-if "df" not in st.session_state:
-    st.session_state.df = load_df()
-df = st.session_state.df
+def refresh_df():
+    """Sau khi ghi: đổi phiên bản dữ liệu → mọi replica/phiên nạp lại ở lần chạy kế tiếp."""
+    try:
+        bump_data_version()
+    except Exception as e:
+        # không đổi được phiên bản → ít nhất làm mới cache của tiến trình này
+        st.warning(f"⚠️ Không cập nhật được phiên bản dữ liệu: {e}")
+        fetch_df.clear()
+    probe_data_version.clear()
+
+# Mỗi lần chạy lấy bảng dùng chung theo phiên bản hiện tại (không giữ bản riêng trong session)
+df = load_df(probe_data_version())
 
 # ==========================
 # MENU
@@ -390,6 +1281,7 @@ menu = [
     "🎁 Tạo mã QR hàng loạt",
     "📤 Xuất ra Excel",
     "📊 Thống kê",
+    "🧪 Kiểm tra dữ liệu",
     "🤖 Trợ lý AI"
 ]
 choice = st.sidebar.radio("📌 Chọn chức năng", menu, index=0)
@@ -399,9 +1291,34 @@ choice = st.sidebar.radio("📌 Chọn chức năng", menu, index=0)
 # ==========================
 if choice == "📋 Xem danh sách":
     st.subheader("📋 Danh sách xe đã đăng ký")
-    df_show = clean_df(df.copy())
-    if "Biển số" in df_show.columns:
-        df_show["Biển số"] = df_show["Biển số"].apply(dinh_dang_bien_so)
+    f1, f2, f3 = st.columns([2, 2, 1])
+    with f1:
+        units = st.multiselect("Đơn vị", list(df["Tên đơn vị"].cat.categories))
+    with f2:
+        roles = st.multiselect("Chức vụ", list(df["Chức vụ"].cat.categories))
+    with f3:
+        plate_prefix = st.text_input("Đầu biển số", placeholder="VD: 51F")
+    s1, s2, s3 = st.columns([2, 1, 1])
+    with s1:
+        sort_col = st.selectbox("Sắp xếp theo", ["STT", "Họ tên", "Biển số", "Mã thẻ", "Tên đơn vị", "Chức vụ"])
+    with s2:
+        ascending = st.radio("Thứ tự", ["Tăng", "Giảm"], horizontal=True) == "Tăng"
+    with s3:
+        page_size = st.selectbox("Số dòng/trang", [25, 50, 100, 200], index=1)
+
+    # Lưu bộ lọc để "🎁 Tạo mã QR hàng loạt" dùng lại cho "Danh sách đang lọc"
+    st.session_state.list_filter = dict(units=tuple(units), roles=tuple(roles), plate_prefix=plate_prefix,
+                                        sort_col=sort_col, ascending=ascending)
+    pos = list_view_positions(df.attrs.get("loaded_at", 0), _df=df, **st.session_state.list_filter)
+
+    total = len(pos)
+    n_pages = max(1, -(-total // page_size))
+    page = st.number_input(f"Trang (1–{n_pages})", min_value=1, max_value=n_pages, value=1, step=1)
+    start = (int(page) - 1) * page_size
+    sub = df.iloc[pos[start:start + page_size]]
+    # Chỉ gửi trang đang xem xuống trình duyệt
+    df_show = sub[public_cols(sub)].assign(**{"Biển số": dinh_dang_bien_so_series(sub["Biển số"])})
+    st.caption(f"Hiển thị {min(start + 1, total)}–{start + len(sub)} / {total} xe (tổng {len(df)}).")
     st.dataframe(df_show, hide_index=True, use_container_width=True)
 
 elif choice == "🔍 Tìm kiếm xe":
@@ -410,9 +1327,7 @@ elif choice == "🔍 Tìm kiếm xe":
     allow_fuzzy = st.checkbox("Cho phép gợi ý gần đúng nếu không khớp tuyệt đối", value=True)
     if bien_so_input:
         bien_so_norm = normalize_plate(bien_so_input)
-        df_tmp = df.copy()
-        df_tmp["Biển số chuẩn hóa"] = df_tmp["Biển số"].astype(str).apply(normalize_plate)
-        ket_qua = df_tmp[df_tmp["Biển số chuẩn hóa"] == bien_so_norm]
+        ket_qua = df[df["__plate_norm"] == bien_so_norm]
         if ket_qua.empty and allow_fuzzy:
             st.info("Không khớp tuyệt đối. Thử gợi ý gần đúng…")
             # gợi ý gần đúng đơn giản
@@ -428,20 +1343,21 @@ elif choice == "🔍 Tìm kiếm xe":
                 scores.append((idx, s))
             scores.sort(key=lambda x: x[1], reverse=True)
             idxs = [i for i, _ in scores[:20]]
-            top = df.loc[idxs].copy()
+            top = df.loc[idxs, public_cols(df)]
             st.success(f"✅ Gợi ý gần đúng (top {len(top)}):")
             st.dataframe(top, hide_index=True, use_container_width=True)
         elif ket_qua.empty:
             st.warning("🚫 Không tìm thấy xe nào khớp với biển số đã nhập.")
         else:
             st.success(f"✅ Tìm thấy {len(ket_qua)} xe khớp.")
-            st.dataframe(ket_qua.drop(columns=["Biển số chuẩn hóa"]), hide_index=True, use_container_width=True)
+            st.dataframe(ket_qua[public_cols(ket_qua)], hide_index=True, use_container_width=True)
 
 elif choice == "➕ Đăng ký xe mới":
     st.subheader("📋 Đăng ký xe mới")
-    df_current = df.copy()
-    ten_don_vi = st.selectbox("Chọn đơn vị", list(DON_VI_MAP.keys()))
-    ma_don_vi = DON_VI_MAP[ten_don_vi]
+    df_current = df
+    units_reg = unit_registry()
+    ma_don_vi = st.selectbox("Chọn đơn vị", list(units_reg["name"]), format_func=lambda c: units_reg["name"][c])
+    ten_don_vi = units_reg["name"][ma_don_vi]
     col1, col2 = st.columns(2)
     with col1:
         ho_ten_raw = st.text_input("Họ tên")
@@ -453,10 +1369,9 @@ elif choice == "➕ Đăng ký xe mới":
     ho_ten = format_name(ho_ten_raw)
     chuc_vu = format_name(chuc_vu_raw)
     bien_so = dinh_dang_bien_so(bien_so_raw)
-    bien_so_da_dang_ky = df_current["Biển số"].dropna().apply(dinh_dang_bien_so)
 
     if st.button("📥 Đăng ký"):
-        if bien_so in bien_so_da_dang_ky.values:
+        if normalize_plate(bien_so) in set(df_current["__plate_norm"]):
             st.error("🚫 Biển số này đã được đăng ký trước đó!")
         elif so_dien_thoai and not str(so_dien_thoai).startswith("0"):
             st.warning("⚠️ Số điện thoại phải bắt đầu bằng số 0.")
@@ -475,14 +1390,14 @@ elif choice == "➕ Đăng ký xe mới":
                 st.success(f"✅ Đã đăng ký xe cho `{ho_ten}` với mã thẻ: `{ma_the}`")
          
                 # Tạo QR cho xe vừa đăng ký (mở qua GitHub)
-                link  = make_qr_link_from_row({"Mã thẻ": ma_the, "Biển số": bien_so})
+                link  = make_qr_link(ma_the, bien_so, ma_don_vi, signing_key=qr_signing_key())
                 qr_png = make_qr_bytes(link)
 
 
                 st.image(qr_png, caption=f"QR cho {bien_so}", width=200)
                 st.download_button("📥 Tải mã QR", data=qr_png, file_name=f"QR_{bien_so}.png", mime="image/png")
                 st.caption("Quét mã sẽ yêu cầu mật khẩu trước khi xem thông tin.")
-                st.session_state.df = load_df()
+                refresh_df()
             except Exception as e:
                 st.error(f"❌ Lỗi ghi dữ liệu: {e}")
 
@@ -491,14 +1406,12 @@ elif choice == "✏️ Cập nhật xe":
     bien_so_input = st.text_input("Nhập biển số xe cần cập nhật")
     if bien_so_input:
         bien_so_norm = normalize_plate(bien_so_input)
-        df_tmp = df.copy()
-        df_tmp["Biển số chuẩn hóa"] = df_tmp["Biển số"].astype(str).apply(normalize_plate)
-        ket_qua = df_tmp[df_tmp["Biển số chuẩn hóa"] == bien_so_norm]
+        ket_qua = df[df["__plate_norm"] == bien_so_norm]
         if ket_qua.empty:
             st.error("❌ Không tìm thấy biển số xe!")
         else:
             st.success(f"✅ Tìm thấy {len(ket_qua)} xe khớp.")
-            st.dataframe(ket_qua.drop(columns=["Biển số chuẩn hóa"]), hide_index=True, use_container_width=True)
+            st.dataframe(ket_qua[public_cols(ket_qua)], hide_index=True, use_container_width=True)
             idx_np = ket_qua.index[0]
             index = int(idx_np)
             row = ket_qua.iloc[0]
@@ -515,23 +1428,20 @@ elif choice == "✏️ Cập nhật xe":
                 email_moi = st.text_input("Email", value=str(row["Email"]))
             if st.button("Cập nhật"):
                 try:
-                    try:
-                        stt_val = int(row.get("STT", ""))
-                    except Exception:
-                        stt_val = str(row.get("STT", ""))
+                    stt = row.get("STT", "")
+                    stt_val = "" if pd.isna(stt) else int(stt)
                     payload = [
                         stt_val, ho_ten_moi, bien_so_moi, str(row["Mã thẻ"]),
                         ma_don_vi_moi, ten_don_vi_moi, chuc_vu_moi, so_dien_thoai_moi, email_moi
                     ]
                     gs_retry(ws.update, f"A{index+2}:I{index+2}", [payload])
                     st.success("✅ Đã cập nhật thông tin xe thành công!")
-                    norm = normalize_plate(bien_so_moi)
-                    link = f"https://qrcarump.streamlit.app/?id={urllib.parse.quote(norm)}"
+                    link = make_qr_link(str(row["Mã thẻ"]), bien_so_moi, ma_don_vi_moi, signing_key=qr_signing_key())
                     qr_png = make_qr_bytes(link)
                     st.image(qr_png, caption=f"QR cho {bien_so_moi}", width=200)
                     st.download_button("📥 Tải mã QR", data=qr_png, file_name=f"QR_{bien_so_moi}.png", mime="image/png")
                     st.caption("Quét mã sẽ yêu cầu mật khẩu trước khi xem thông tin.")
-                    st.session_state.df = load_df()
+                    refresh_df()
                 except Exception as e:
                     st.error(f"❌ Lỗi cập nhật: {e}")
 
@@ -541,21 +1451,19 @@ elif choice == "🗑️ Xóa xe":
     if bien_so_input:
         try:
             bien_so_norm = normalize_plate(bien_so_input)
-            df_tmp = df.copy()
-            df_tmp["Biển số chuẩn hóa"] = df_tmp["Biển số"].astype(str).apply(normalize_plate)
-            ket_qua = df_tmp[df_tmp["Biển số chuẩn hóa"] == bien_so_norm]
+            ket_qua = df[df["__plate_norm"] == bien_so_norm]
             if ket_qua.empty:
                 st.error("❌ Không tìm thấy biển số xe!")
             else:
                 st.success(f"✅ Tìm thấy {len(ket_qua)} xe khớp.")
-                st.dataframe(ket_qua.drop(columns=["Biển số chuẩn hóa"]), hide_index=True, use_container_width=True)
+                st.dataframe(ket_qua[public_cols(ket_qua)], hide_index=True, use_container_width=True)
                 idx_np = ket_qua.index[0]
                 index = int(idx_np)
                 row = ket_qua.iloc[0]
                 if st.button("Xác nhận xóa"):
                     gs_retry(ws.delete_rows, int(index) + 2)
                     st.success(f"🗑️ Đã xóa xe có biển số `{row['Biển số']}` thành công!")
-                    st.session_state.df = load_df()
+                    refresh_df()
         except Exception as e:
             st.error(f"⚠️ Lỗi khi xử lý: {e}")
 
@@ -564,6 +1472,7 @@ elif choice == "📥 Tải dữ liệu lên":
     up = st.file_uploader("Chọn tệp Excel (.xlsx) hoặc CSV", type=["xlsx", "csv"])
     mode = st.selectbox("Chế độ ghi dữ liệu", ["Thêm (append)", "Thay thế toàn bộ (replace all)", "Upsert"])
     dry_run = st.checkbox("🔎 Chạy thử (không ghi Google Sheets)")
+    force_write = st.checkbox("⚠️ Vẫn ghi khi dữ liệu nhập có lỗi chất lượng")
 
     if up is not None:
         try:
@@ -598,10 +1507,54 @@ elif choice == "📥 Tải dữ liệu lên":
                         if c not in df_cur.columns:
                             df_cur[c] = ""
 
-                df_to_write = fill_missing_codes_strict(df_up, df_cur)
+                # Mọi so khớp đều làm TRƯỚC khi sinh mã thẻ: mã mới sinh cho dòng chưa có thẻ sẽ không khớp
+                # được dòng cũ trên sheet (cùng biển số) và 2 dòng cùng biển số trong tệp sẽ nhận 2 mã khác nhau.
+                df_up["Mã đơn vị"] = resolve_unit_codes(df_up["Tên đơn vị"], df_up["Mã đơn vị"])
+                df_up = match_existing_cards(df_up, df_cur)
+                # Dòng trùng khóa trong tệp (Mã thẻ, nếu trống thì biển số chuẩn hóa): giữ dòng cuối cùng
+                key_up = _keyify(df_up)
+                dup_mask = key_up.ne("") & key_up.duplicated(keep="last")
+                dup_up = df_up[dup_mask]
+                df_up = df_up[~dup_mask]
+
+                # Xem trước thay đổi (so khớp theo Mã thẻ / biển số chuẩn hóa); chỉ dòng thêm mới mới sinh mã thẻ
+                diff = diff_upload(df_cur, df_up)
+                diff["insert"] = fill_missing_codes_strict(diff["insert"], df_cur)
+                if mode == "Upsert":
+                    df_to_write = pd.concat([diff["update"][REQUIRED_COLUMNS], diff["insert"]])
+                else:
+                    df_to_write = fill_missing_codes_strict(df_up, df_cur)
+                c1, c2, c3, c4 = st.columns(4)
+                if mode == "Upsert":
+                    c1.metric("➕ Thêm mới", len(diff["insert"]))
+                    c2.metric("✏️ Cập nhật", len(diff["update"]))
+                    c3.metric("⏸️ Không đổi", len(diff["unchanged"]))
+                elif mode == "Thêm (append)":
+                    c1.metric("➕ Sẽ thêm", len(df_to_write))
+                    c2.metric("⚠️ Đã có trên sheet", len(diff["update"]) + len(diff["unchanged"]))
+                else:
+                    c1.metric("📝 Sẽ ghi", len(df_to_write))
+                    c2.metric("🗑️ Thay thế", len(df_cur))
+                c4.metric("♊ Trùng trong tệp", len(dup_up))
+                if mode == "Upsert" and not diff["changes"].empty:
+                    with st.expander(f"Chi tiết {len(diff['changes'])} trường thay đổi"):
+                        st.dataframe(diff["changes"], hide_index=True, use_container_width=True)
+                if not dup_up.empty:
+                    with st.expander("Dòng trùng khóa trong tệp (bỏ qua, chỉ giữ dòng cuối)"):
+                        st.dataframe(dup_up, hide_index=True, use_container_width=True)
+
+                # Kiểm tra chất lượng trên bảng kết quả, chỉ xét các dòng do lần nhập này tác động
+                df_after, touched = simulate_import(df_cur, df_to_write, diff, mode)
+                issues = scan_data_quality(df_after)
+                issues = issues[issues["Dòng"].isin(touched)]
+                if not issues.empty:
+                    st.warning(f"⚠️ Phát hiện {len(issues)} lỗi chất lượng ở các dòng sắp ghi.")
+                    st.dataframe(issues, hide_index=True, use_container_width=True)
 
                 if dry_run:
                     st.info("🔎 Chạy thử: không ghi Google Sheets.")
+                elif not issues.empty and not force_write:
+                    st.error("⛔ Đã dừng ghi do dữ liệu lỗi. Sửa tệp hoặc chọn 'Vẫn ghi khi dữ liệu nhập có lỗi chất lượng'.")
                 else:
                     if mode == "Thêm (append)":
                         added = write_bulk_block(ws, df_cur, df_to_write, columns=REQUIRED_COLUMNS)
@@ -614,50 +1567,14 @@ elif choice == "📥 Tải dữ liệu lên":
                             gs_retry(ws.update, f"A2:I{1+len(vals)}", vals)
                         st.success(f"✅ Đã thay thế toàn bộ dữ liệu ({len(df_to_write)} dòng).")
                     else:
-                        # Upsert nhanh
-                        df_cur2 = df_cur.copy()
-                        def _keyify(d):
-                            k1 = d.get("Mã thẻ", pd.Series([""]*len(d))).astype(str).str.upper().str.strip()
-                            k2 = d["Biển số"].astype(str).map(normalize_plate) if "Biển số" in d.columns else pd.Series([""]*len(d))
-                            return k1.where(k1 != "", k2)
-
-                        df_cur2["__KEY__"] = _keyify(df_cur2)
-                        df_to_write["__KEY__"] = _keyify(df_to_write)
-                        key_to_row = {k: i for i, k in df_cur2["__KEY__"].items() if str(k).strip() != ""}
-
-                        updates, inserts = [], []
-                        for _, r in df_to_write.iterrows():
-                            key = str(r["__KEY__"]).strip()
-                            payload = [str(r.get(c, "")) for c in REQUIRED_COLUMNS]
-                            if key and key in key_to_row:
-                                idx0 = int(key_to_row[key])
-                                updates.append((idx0+2, payload))
-                            else:
-                                inserts.append(payload)
-
-                        updates.sort(key=lambda x: x[0])
-                        grp, prev = [], None
-                        for rownum, payload in updates:
-                            if prev is None or rownum == prev + 1:
-                                grp.append((rownum, payload))
-                            else:
-                                rng = f"A{grp[0][0]}:I{grp[-1][0]}"
-                                gs_retry(ws.update, rng, [p for _, p in grp])
-                                grp = [(rownum, payload)]
-                            prev = rownum
-                        if grp:
-                            rng = f"A{grp[0][0]}:I{grp[-1][0]}"
-                            gs_retry(ws.update, rng, [p for _, p in grp])
-
-                        if inserts:
-                            start = len(df_cur2) + 2
-                            for i in range(0, len(inserts), 500):
-                                blk = inserts[i:i+500]
-                                end_row = start + i + len(blk) - 1
-                                rng = f"A{start+i}:I{end_row}"
-                                gs_retry(ws.update, rng, blk)
-
-                        st.success(f"✅ Upsert xong: cập nhật {len(updates)} • thêm mới {len(inserts)}.")
+                        # Upsert: chỉ ghi dòng thật sự thay đổi
+                        upd = diff["update"]
+                        updates = list(zip(upd["__ROW__"].tolist(), upd[REQUIRED_COLUMNS].values.tolist()))
+                        write_row_groups(ws, updates, REQUIRED_COLUMNS)
+                        added = write_bulk_block(ws, df_cur, diff["insert"], columns=REQUIRED_COLUMNS)
+
+                        st.success(f"✅ Upsert xong: cập nhật {len(updates)} • thêm mới {added} • bỏ qua {len(diff['unchanged'])} dòng không đổi.")
+                    refresh_df()
 
                 st.dataframe(df_to_write.head(20), hide_index=True, use_container_width=True)
             except Exception as e:
@@ -665,29 +1582,35 @@ elif choice == "📥 Tải dữ liệu lên":
 
 elif choice == "🎁 Tạo mã QR hàng loạt":
     st.subheader("🎁 Tạo mã QR hàng loạt")
-    BASE_URL_QR = "https://dhnamgh.github.io/car/index.html"  # GH Pages của bạn
     src_opt = st.radio("Chọn nguồn dữ liệu", ["Toàn bộ danh sách", "Danh sách đang lọc"], horizontal=True)
-    if src_opt == "Danh sách đang lọc" and 'df_show' in locals():
-        df_qr = df_show.copy()
+    if src_opt == "Danh sách đang lọc" and "list_filter" in st.session_state:
+        pos = list_view_positions(df.attrs.get("loaded_at", 0), _df=df, **st.session_state.list_filter)
+        df_qr = df.iloc[pos][public_cols(df)]
     else:
-        df_qr = df.copy()
-    df_qr = clean_df(df_qr)
+        df_qr = df[public_cols(df)]
     for col in ["Mã thẻ", "Biển số", "Mã đơn vị"]:
         if col not in df_qr.columns:
             df_qr[col] = ""
     st.info(f"Mỗi QR sẽ mở: {BASE_URL_QR}?id=<MãThẻ>")
+    signing_key = qr_signing_key()
+    c1, c2 = st.columns(2)
+    with c1:
+        signed = st.checkbox("🔏 Ký số QR (cổng xác thực tại chỗ, không cần tra danh bạ)",
+                             value=bool(signing_key), disabled=not signing_key,
+                             help=None if signing_key else "Cần secrets['qr_signing_key']")
+    with c2:
+        ttl_days = st.number_input("Hiệu lực QR ký số (ngày)", min_value=1, max_value=3650, value=365, disabled=not signed)
     if st.button("⚡ Tạo ZIP mã QR"):
-        files = []
+        files, links = [], []
         for _, r in df_qr.iterrows():
-            vid = str(r.get("Mã thẻ", "")).strip()
-            if not vid and "Biển số" in df_qr.columns:
-                vid = normalize_plate(r.get("Biển số", ""))
+            vid = qr_target_id_from_row(r)
             if not vid:
                 continue
-            url = f"{BASE_URL_QR}?id={urllib.parse.quote(vid)}"
+            url = make_qr_link_from_row(r, signing_key=signing_key if signed else b"", ttl_days=int(ttl_days))
             png = make_qr_bytes(url)
             unit = str(r.get("Mã đơn vị", "")).strip().upper() or "NO_UNIT"
             files.append((f"{unit}/{vid}.png", png))
+            links.append((r.get("Mã thẻ", ""), r.get("Biển số", ""), unit, url))
         if not files:
             st.warning("Không có bản ghi hợp lệ để tạo QR.")
         else:
@@ -695,6 +1618,9 @@ elif choice == "🎁 Tạo mã QR hàng loạt":
             with zipfile.ZipFile(bio, "w", zipfile.ZIP_STORED) as zf:
                 for name, data in files:
                     zf.writestr(name, data)
+                # Danh sách link để đối chiếu khi cấp lại QR
+                zf.writestr("links.csv", pd.DataFrame(links, columns=["Mã thẻ", "Biển số", "Mã đơn vị", "Link"])
+                            .to_csv(index=False).encode("utf-8-sig"))
             bio.seek(0)
             st.download_button("⬇️ Tải ZIP QR (phân theo đơn vị)",
                                data=bio.getvalue(),
@@ -706,7 +1632,7 @@ elif choice == "📤 Xuất ra Excel":
     st.subheader("📤 Tải danh sách xe dưới dạng Excel")
     output = BytesIO()
     with pd.ExcelWriter(output, engine='openpyxl') as writer:
-        df.to_excel(writer, index=False, sheet_name='DanhSachXe')
+        df[public_cols(df)].to_excel(writer, index=False, sheet_name='DanhSachXe')
     processed_data = output.getvalue()
     st.download_button(label="📥 Tải Excel",
                        data=processed_data,
@@ -715,60 +1641,21 @@ elif choice == "📤 Xuất ra Excel":
 
 elif choice == "📊 Thống kê":
     st.markdown("## 📊 Dashboard thống kê xe theo đơn vị")
-    df_stats = df.copy()
-
-    import unicodedata
-    def _unit_norm(x: str) -> str:
-        s = "" if x is None else str(x)
-        s = s.replace("\xa0", " ")
-        s = unicodedata.normalize("NFKC", s)
-        s = s.replace("Ð", "Đ").replace("đ", "Đ")
-        s = re.sub(r"\s+", " ", s).strip()
-        return s
-
-    df_stats["__unit"] = df_stats["Tên đơn vị"].apply(_unit_norm)
-
-    ten_day_du = {
-        "HCTH": "Phòng Hành Chính Tổng hợp",
-        "TCCB": "Phòng Tổ chức Cán bộ",
-        "ĐTĐH": "Phòng Đào tạo Đại học",
-        "ĐTSĐH": "Phòng Đào tạo Sau đại học",
-        "KHCN": "Phòng Khoa học Công nghệ",
-        "KHTC": "Phòng Kế hoạch Tài chính",
-        "QTGT": "Phòng Quản trị Giáo tài",
-        "TTPC": "Phòng Thanh tra Pháp chế",
-        "ĐBCLGD&KT": "Phòng Đảm bảo chất lượng GD và Khảo thí",
-        "CTSV": "Phòng Công tác sinh viên",
-        "KHCB": "Khoa Khoa học Cơ bản",
-        "RHM": "Khoa Răng hàm mặt",
-        "YTCC": "Khoa Y tế Công cộng",
-        "PK.CKRHM": "Phòng khám Răng hàm mặt",
-        "TT.KCCLXN": "Trung tâm Kiểm chuẩn Chât lượng xét nghiệm",
-        "TT.KHCN UMP": "Trung tâm Khoa học Công nghệ UMP",
-        "TT.YSHPT": "Trung tâm Y sinh học phân tử",
-        "KTX": "Ký túc xá",
-        "BV ĐHYD": "Bệnh viện Đại học Y Dược",
-        "TT.PTTN": "Trung tâm Phẫn thuật thực nghiệm",
-        "TT. GDYH": "Trung tâm Giáo dục Y học",
-        "VPĐ": "Văn phòng Đoàn thể",
-        "Trường Y": "Trường Y",
-        "Trường Dược": "Trường Dược",
-        "Trường ĐD-KTYH": "Trường Điều dưỡng - Kỹ thuật Y học",
-        "Thư viện": "Thư viện",
-        "Tạp chí Y học": "Tạp chí Y học",
-        "YHCT": "Khoa Y học Cổ truyền",
-        "HTQT": "Phòng Hợp tác Quốc tế",
-        "TT.ĐTNLYT": "Trung tâm ĐT Nhân lực Y tế"
-    }
+    # Gom theo mã đơn vị (cách viết khác / bí danh vẫn về cùng đơn vị); tên lạ giữ nguyên để vẫn thống kê
+    reg = unit_registry()
+    ma = resolve_unit_codes(df["Tên đơn vị"], registry=reg)
+    ten_goc = df["Tên đơn vị"].astype(str).str.strip()
+    units = pd.DataFrame({
+        "Tên đơn vị": ma.map(reg["name"]).where(ma != "", ten_goc),
+        "Tên đầy đủ": ma.map(reg["full"]).where(ma != "", ten_goc),
+    })
 
     thong_ke = (
-        df_stats.groupby("__unit", dropna=False)
+        units.groupby(["Tên đơn vị", "Tên đầy đủ"], dropna=False)
         .size()
         .reset_index(name="Số lượng xe")
-        .rename(columns={"__unit": "Tên đơn vị"})
     )
     thong_ke = thong_ke.sort_values(by="Số lượng xe", ascending=False)
-    thong_ke["Tên đầy đủ"] = thong_ke["Tên đơn vị"].apply(lambda x: ten_day_du.get(x, x))
 
     import plotly.express as px
     fig = px.bar(thong_ke, x="Tên đơn vị", y="Số lượng xe", color="Tên đơn vị", text="Số lượng xe",
@@ -784,6 +1671,61 @@ elif choice == "📊 Thống kê":
     thong_ke_display["Số lượng xe"] = thong_ke_display["Số lượng xe"].astype(str)
     st.dataframe(thong_ke_display, hide_index=True, use_container_width=True)
 
+    if GATE_LOG_ENABLED:
+        st.markdown("#### 🚧 Lưu lượng cổng theo giờ")
+        try:
+            if flush_gate_log(force=True):
+                load_gate_events.clear()
+            events = load_gate_events()
+        except Exception as e:
+            st.warning(f"⚠️ Không đọc được nhật ký cổng: {e}")
+            events = pd.DataFrame(columns=GATE_LOG_COLUMNS)
+        if events.empty:
+            st.info("Chưa có lượt quét nào.")
+        else:
+            ngay = st.date_input("Ngày", value=datetime.now(LOCAL_TZ).date())
+            ev_day = events[events["Thời gian"].astype(str).str.startswith(ngay.strftime("%Y-%m-%d"))]
+            hourly = gate_hourly_stats(ev_day)
+            if hourly.empty:
+                st.info("Không có lượt quét trong ngày đã chọn.")
+            else:
+                g1, g2, g3 = st.columns(3)
+                g1.metric("Lượt quét", int(hourly["Lượt quét"].sum()))
+                g2.metric("Giờ cao điểm", hourly.loc[hourly["Lượt quét"].idxmax(), "Giờ"].strftime("%H:00"))
+                g3.metric("Xe trong trường (hiện tại)", int(hourly["Xe trong trường"].iloc[-1]))
+                fig_gate = px.bar(hourly, x="Giờ", y=["Vào", "Ra"], barmode="group", title="Lượt vào/ra theo giờ")
+                fig_gate.add_scatter(x=hourly["Giờ"], y=hourly["Xe trong trường"], mode="lines+markers", name="Xe trong trường")
+                st.plotly_chart(fig_gate, use_container_width=True)
+
+    with st.expander("💾 Bộ nhớ bảng dữ liệu"):
+        rep = memory_report(df)
+        raw_kb, now_kb = rep["Gốc (KB)"].sum(), rep["Gọn (KB)"].sum()
+        # Mọi số đều đo bằng memory_usage(deep=True). Trước: đo lúc nạp trên bản riêng + bản copy của trang (compact_df);
+        # Sau: các DataFrame phiên này đang giữ riêng trong session_state (bảng xe chỉ là tham chiếu dùng chung)
+        before_kb = df.attrs.get("legacy_session_bytes", 0) / 1024
+        after_kb = sum(int(v.memory_usage(deep=True).sum()) for v in st.session_state.to_dict().values()
+                       if isinstance(v, pd.DataFrame)) / 1024
+        m1, m2, m3 = st.columns(3)
+        m1.metric("Mỗi phiên (trước)", f"{before_kb:,.0f} KB")
+        m2.metric("Mỗi phiên (sau)", f"{after_kb:,.0f} KB", delta=f"{after_kb - before_kb:,.0f} KB", delta_color="inverse")
+        m3.metric("Bảng gọn dùng chung/tiến trình", f"{now_kb:,.0f} KB", delta=f"{now_kb - raw_kb:,.0f} KB so với bản gốc", delta_color="inverse")
+        st.dataframe(rep, use_container_width=True)
+
+
+elif choice == "🧪 Kiểm tra dữ liệu":
+    st.subheader("🧪 Kiểm tra chất lượng dữ liệu")
+    t0 = time.perf_counter()
+    # Khóa cache = lần nạp bảng (đổi khi dữ liệu đổi) + phiên bản danh mục đơn vị, không hash toàn bảng
+    issues = scan_data_quality_cached(f"{df.attrs.get('loaded_at', 0)}:{unit_registry()['version']}", df)
+    st.caption(f"Đã quét {len(df)} dòng trong {(time.perf_counter() - t0) * 1000:.0f} ms.")
+    if issues.empty:
+        st.success("✅ Không phát hiện lỗi dữ liệu.")
+    else:
+        tong_hop = issues.groupby("Lỗi").size().reset_index(name="Số dòng").sort_values("Số dòng", ascending=False)
+        st.dataframe(tong_hop, hide_index=True, use_container_width=True)
+        loai = st.multiselect("Lọc theo loại lỗi", tong_hop["Lỗi"].tolist())
+        view = issues[issues["Lỗi"].isin(loai)] if loai else issues
+        st.dataframe(view, hide_index=True, use_container_width=True)
 
 elif choice == "🤖 Trợ lý AI":
     st.subheader("🤖 Trợ lý AI (lọc theo TỪ trọn vẹn, nhiều từ – AND, phân biệt dấu)")
@@ -802,11 +1744,7 @@ elif choice == "🤖 Trợ lý AI":
 
     q_raw = st.text_input("Nhập từ khóa (ví dụ: 'an', 'đạt', 'nam văn', '73', 'TRY', 'BVY', 'Trường Y', 'BV ĐHYD')").strip()
     if q_raw:
-        base = df.copy()
-        base["__name_tokens"] = base.get("Họ tên", "").astype(str).apply(name_tokens_vn)
-        base["__plate_norm"]  = base.get("Biển số", "").astype(str).apply(normalize_plate)
-        base["__unit_code"]   = base.get("Mã đơn vị", "").astype(str).str.upper().str.strip()
-        base["__card_code"]   = base.get("Mã thẻ", "").astype(str).str.upper().str.strip()
+        base = df
 
         q_up    = q_raw.upper()
         q_tokens = query_tokens_vn(q_raw)
@@ -818,23 +1756,24 @@ elif choice == "🤖 Trợ lý AI":
             res = res[res["__plate_norm"].str.contains(q_raw, na=False)]
         else:
             # 2) Mã đơn vị / mã thẻ (ưu tiên)
-            if q_up in DON_VI_MAP.values():                # ví dụ TRY, BVY
-                res = res[res["__unit_code"].eq(q_up)]
-            elif re.fullmatch(r"[A-Z]{3}\d{3}", q_up):     # ví dụ TRY012
-                res = res[res["__card_code"].eq(q_up)]
+            reg = unit_registry()
+            if q_up in reg["name"]:                        # ví dụ TRY, BVY
+                res = res[res["Mã đơn vị"].astype(str).str.upper().str.strip().eq(q_up)]
+            elif re.fullmatch(CARD_RE, q_up):              # ví dụ TRY012, TV003
+                res = res[res["Mã thẻ"].eq(q_up)]
             else:
-                # 3) Tên đơn vị chuẩn (không fuzzy)
-                if q_up in map(str.upper, DON_VI_MAP.keys()):
-                    res = res[res["Tên đơn vị"].str.upper().eq(q_up)]
+                # 3) Tên đơn vị / tên đầy đủ / bí danh trong danh mục (không fuzzy)
+                if unit_key(q_raw) in reg["alias"]:
+                    res = res[resolve_unit_codes(res["Tên đơn vị"], registry=reg).eq(reg["alias"][unit_key(q_raw)])]
                 else:
                     # 4) Mặc định: AND trên các token họ tên (GIỮ dấu, TỪ trọn vẹn)
                     #    - 'an' chỉ khớp token 'an' (không khớp 'ân', 'ẩn', 'khang'…)
                     #    - 'đạt' khớp đúng 'đạt'
                     #    - 'nam văn' yêu cầu cả 'nam' và 'văn' đều xuất hiện trong tên
                     qset = set(q_tokens)
-                    res = res[res["__name_tokens"].apply(lambda toks: qset.issubset(set(toks)))]
+                    res = res[res["Họ tên"].astype(str).map(lambda s: qset.issubset(name_tokens_vn(s)))]
 
-        res = res.drop(columns=["__name_tokens","__plate_norm","__unit_code","__card_code"], errors="ignore")
+        res = res[public_cols(res)]
 
         if res.empty:
             st.info("Không tìm thấy kết quả trùng khớp.")